@@ -2,16 +2,69 @@
 Calculate metrics for the author
 '''
 import os
+import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from scipy.stats import kendalltau, rankdata
+
+import kernels
 from metrics import *
+from results_store import ResultsStore
 from scopus import data_dir, top_2pc_filepath, affiliations
+from summary import SummaryStatistics
 from utils import read_data
 
+# Columns identifying the author in the metrics rows, every other column is a metric
+id_columns = ['Name', 'Scopus ID']
+
+def metric_columns(authors_df):
+    return [col for col in authors_df.columns if col not in id_columns]
+
+# Calculate the metrics with the kernels on arrays, or with the functions of `metrics.py` if False
+use_kernels = True
+
+def array_metrics(name, scopus_id, citations, num_authors, author_ids, author_offsets):
+    '''
+    The metrics of an author calculated by the kernels on the arrays of their
+    publications, as returned by `kernels.publication_arrays`. The same as the
+    metrics of `metrics.py`.
+    '''
+    positions = kernels.author_positions(author_ids, author_offsets, int(scopus_id))
+    has_authors = num_authors > 0
+    num_pubs = max(has_authors.sum(), 1)
+    first_author = (author_ids[author_offsets[:-1][has_authors] - author_offsets[0]] == int(scopus_id)).sum()
+    last_author = (author_ids[author_offsets[1:][has_authors] - author_offsets[0] - 1] == int(scopus_id)).sum()
+
+    return {
+        'Name': name,
+        'Scopus ID': scopus_id,
+        'Publications': len(citations),
+        'Total citations': int(citations.sum()),
+        'Median citations': np.median(citations),
+        'h-index': kernels.h_index(citations),
+        'h-frac-index': kernels.h_frac_index(citations, num_authors),
+        'hm-index': kernels.hm_index(citations, num_authors),
+        'h-leadership-index': kernels.h_leadership_index(citations, num_authors, positions),
+        '% first author': round(first_author/num_pubs*100, 2),
+        '% last author': round(last_author/num_pubs*100, 2),
+        '% single author': round((num_authors[has_authors] == 1).sum()/num_pubs*100, 2),
+        'Median author position': kernels.median_author_position(positions),
+        'i10-index': int((citations >= 10).sum()),
+        'Average number of Authors': round(np.mean(num_authors[has_authors]), 1),
+        'Median number of Authors': np.median(num_authors[has_authors]),
+    }
+
 def metrics(author, rows=list()):
     '''
     Calculate metrics for the author and append the results to the rows list.
+    The metrics are calculated by the kernels unless `use_kernels` is False,
+    in which case the functions of `metrics.py` are used.
     '''
+    if use_kernels:
+        rows.append(array_metrics(author['name'], author['scopus_id'], *kernels.publication_arrays(author)))
+        return
     try:
         h = h_index(author['publications'])
         h_leadership = h_leadership_index(author['scopus_id'], author['publications'])
@@ -30,6 +83,7 @@ def metrics(author, rows=list()):
 
         rows.append({
             'Name': author['name'],
+            'Scopus ID': author['scopus_id'],
             'Publications': len(author['publications']),
             'Total citations': total_citations(author['publications']),
             'Median citations': median_citations(author['publications']),
@@ -54,38 +108,168 @@ def metrics(author, rows=list()):
 
 def metric_summary(authors_df, metric, store_dir=None):
     '''
-    Calculate the summary statistics for the metric.
+    Calculate the summary statistics for the metric. The authors can also be a
+    `SummaryStatistics` updated by a streaming run or merged from workers.
     '''
-    metric_summary = authors_df[metric].describe()
+    if isinstance(authors_df, SummaryStatistics):
+        metric_summary = authors_df.describe(metric)
+    else:
+        metric_summary = authors_df[metric].describe()
     if store_dir:
         metric_name = metric.replace('-', '_').replace('%', '').replace(' ', '_').lower().strip()
         metric_summary.to_csv(f'{store_dir}/{metric_name}.csv', sep=',', header=True)
     return metric_summary
 
-def correlation_analysis(authors_df, store_dir=None):
+def correlation_analysis(authors_df, store_dir=None, method='pearson'):
     '''
     Perform correlation analysis for the author metrics.
+    The method can be `pearson`, `spearman` or `kendall`.
     '''
-    # Select all columns except Name
-    cols_to_correlate = authors_df.columns[1:]
+    # Select all columns except the author's name and id
+    cols_to_correlate = metric_columns(authors_df)
     position_col = 'Median author position'
 
     # Calculate the correlation matrix
-    correlation_matrix = authors_df[cols_to_correlate].corr()
+    correlation_matrix = authors_df[cols_to_correlate].corr(method=method)
 
     # Extract the correlation values between an author's median position and other metrics
     correlation_with_position = correlation_matrix[position_col].drop(position_col)
 
     # Save the correlation matrix to a CSV file
     if store_dir:
-        correlation_matrix.to_csv(f'{store_dir}/correlation_matrix.csv', sep=',')
-        correlation_with_position.to_csv(f'{store_dir}/correlation_authorship_position.csv', sep=',')
+        suffix = '' if method == 'pearson' else f'_{method}'
+        correlation_matrix.to_csv(f'{store_dir}/correlation_matrix{suffix}.csv', sep=',')
+        correlation_with_position.to_csv(f'{store_dir}/correlation_authorship_position{suffix}.csv', sep=',')
 
     # Print or use the correlation values as needed
     return correlation_with_position
 
+# Largest number of values of the pairwise Kendall concordance matrices, about 128MB
+max_concordance_size = 2**24
+
+def _kendall_concordance(data):
+    '''
+    The sign of the concordance of every pair of rows of `data` between the
+    first column and every other column, of shape (columns - 1, rows, rows).
+    '''
+    signs = np.sign(data[:, None, :] - data[None, :, :])
+    return np.moveaxis(signs[:, :, :1] * signs[:, :, 1:], 2, 0)
+
+def _batch_kendall(data, indices):
+    '''
+    Kendall tau-b of the first column of `data` with every other column for
+    each row of the `indices` matrix, the same as `DataFrame.corr(method='kendall')`
+    on the resamples. A resample is counted by how many times every row is
+    drawn: the pairs drawn from the same row are tied in every column, so the
+    concordant minus discordant pairs are a quadratic form of the counts and
+    the tied pairs are sums over the groups of equal values.
+    '''
+    num_resamples, n = indices.shape
+    offsets = n * np.arange(num_resamples)[:, None]
+    counts = np.bincount((indices + offsets).ravel(), minlength=num_resamples*n).reshape(num_resamples, n).astype(float)
+    score = ((counts @ _kendall_concordance(data)) * counts).sum(axis=2).T / 2 # (replicates, columns - 1)
+
+    tied = np.empty((num_resamples, data.shape[1]))
+    for col in range(data.shape[1]):
+        _, groups = np.unique(data[:, col], return_inverse=True)
+        group_counts = counts @ np.eye(groups.max() + 1)[groups]
+        tied[:, col] = (group_counts * (group_counts - 1)).sum(axis=1) / 2
+    pairs = n * (n - 1) / 2
+    return score / np.sqrt((pairs - tied[:, :1]) * (pairs - tied[:, 1:]))
+
+def _batch_correlation(data, indices, method='pearson'):
+    '''
+    Correlation of the first column of `data` with every other column for each
+    row of the `indices` matrix, where every row holds one bootstrap resample.
+    Returns an array of shape (replicates, columns - 1).
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'kendall':
+            if (data.shape[1] - 1) * len(data)**2 <= max_concordance_size:
+                return _batch_kendall(data, indices)
+            # Kendall tau-b in O(n log n) per resample when the concordance matrices are too large
+            return np.array([
+                [kendalltau(data[resample, 0], data[resample, col]).statistic for col in range(1, data.shape[1])]
+                for resample in indices
+            ]).reshape(len(indices), data.shape[1] - 1)
+
+        sample = data[indices] # (replicates, authors, metrics)
+        if method == 'spearman':
+            # Average ranks for ties, same as `DataFrame.corr(method='spearman')`
+            sample = rankdata(sample, axis=1)
+        centred = sample - sample.mean(axis=1, keepdims=True)
+        covariance = np.einsum('bn,bnk->bk', centred[:, :, 0], centred[:, :, 1:])
+        variance = (centred**2).sum(axis=1)
+        return covariance / np.sqrt(variance[:, :1] * variance[:, 1:])
+
+def _bootstrap_batch(data, sizes, seeds, method='pearson'):
+    '''
+    Draw the bootstrap resamples of the rows of `data` of every block, each
+    block from its own seed, as one index matrix and compute their
+    correlations in one batch.
+    '''
+    indices = np.concatenate([
+        np.random.default_rng(seed).integers(0, len(data), size=(size, len(data)))
+        for size, seed in zip(sizes, seeds)
+    ])
+    return _batch_correlation(data, indices, method)
+
+# Resamples drawn from the same seed, so that the results do not depend on the batches
+bootstrap_block_size = 64
+
+def bootstrap_correlation(authors_df, metric='Median author position', method='pearson',
+                          n_bootstrap=10000, confidence=0.95, n_jobs=1, batch_size=None,
+                          seed=None, store_dir=None):
+    '''
+    Bootstrap confidence intervals for the correlation of the metric with every
+    other metric. Authors missing any of the metrics are dropped. The resamples
+    are drawn in blocks, each with its own seed so that the results do not
+    depend on `n_jobs` or `batch_size`, and the batches of blocks can be
+    spread across a process pool. Kendall's tau is batched too unless the
+    pairwise concordance matrices of the authors exceed `max_concordance_size`,
+    in which case it is computed one resample at a time and is best run with
+    `n_jobs=None`.
+    '''
+    cols_to_correlate = [metric] + [col for col in metric_columns(authors_df) if col != metric]
+    metrics_df = authors_df[cols_to_correlate].dropna()
+    data = metrics_df.to_numpy(dtype=float)
+    num_authors, num_metrics = data.shape
+
+    workers = n_jobs or os.cpu_count() or 1
+    if batch_size is None:
+        # Keep every batch at around 16M values in memory, with a batch for every worker
+        batch_size = max(1, min(2**24 // max(1, num_authors*num_metrics), -(-n_bootstrap // workers)))
+    block_sizes = [min(bootstrap_block_size, n_bootstrap - start) for start in range(0, n_bootstrap, bootstrap_block_size)]
+    block_seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    blocks_per_batch = -(-batch_size // bootstrap_block_size)
+    sizes = [block_sizes[start:start+blocks_per_batch] for start in range(0, len(block_sizes), blocks_per_batch)]
+    seeds = [block_seeds[start:start+blocks_per_batch] for start in range(0, len(block_seeds), blocks_per_batch)]
+
+    bootstrap_batch = partial(_bootstrap_batch, data, method=method)
+    if n_jobs == 1:
+        replicates = list(map(bootstrap_batch, sizes, seeds))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunksize = -(-len(sizes) // workers)
+            replicates = list(executor.map(bootstrap_batch, sizes, seeds, chunksize=chunksize))
+    replicates = np.concatenate(replicates)
+
+    alpha = (1 - confidence) / 2
+    correlation = metrics_df.corr(method=method)[metric].drop(metric)
+    bootstrap_df = pd.DataFrame({
+        'Correlation': correlation,
+        'Standard error': np.nanstd(replicates, axis=0, ddof=1),
+        'CI lower': np.nanquantile(replicates, alpha, axis=0),
+        'CI upper': np.nanquantile(replicates, 1 - alpha, axis=0),
+    }, index=correlation.index)
+
+    if store_dir:
+        metric_name = metric.replace('-', '_').replace('%', '').replace(' ', '_').lower().strip()
+        bootstrap_df.to_csv(f'{store_dir}/correlation_{metric_name}_{method}_bootstrap.csv', sep=',')
+    return bootstrap_df
+
 if __name__ == '__main__':
-    results_dir = 'results'
+    store = ResultsStore()
 
     # # Read the top 2% researchers dataset
     # rows = []
@@ -94,15 +278,16 @@ if __name__ == '__main__':
     #     metrics(author, rows)
     # authors_df = pd.DataFrame(rows)
 
-    # # Store the metrics in a CSV file
-    # store_dir = f'{results_dir}/top_2pc'
-    # authors_df.to_csv(f'{store_dir}/metrics.csv', sep=',', index=False)
-    # metric_summary(authors_df, 'h-leadership-index', store_dir)
-    # correlation_analysis(authors_df, store_dir)
+    # # Store the metrics in the results store
+    # store.write_metrics('top_2pc', authors_df)
+    # store.write_summary('top_2pc', metric_summary(authors_df, 'h-leadership-index'))
+    # store.write_correlations('top_2pc', authors_df[metric_columns(authors_df)].corr())
+    # store.write('correlation_bootstrap', 'top_2pc', bootstrap_correlation(authors_df, method='spearman', n_jobs=None, seed=0), index_label='Other metric')
 
     # Read reseachers fetched using affiliation
     for affiliation in list(affiliations.values()):
-        file_dir = f'{data_dir}/{affiliation["affiliation"]}'
+        affiliation_name = affiliation["affiliation"]
+        file_dir = f'{data_dir}/{affiliation_name}'
         files = os.listdir(file_dir)
         rows = []
         for file in files:
@@ -112,10 +297,12 @@ if __name__ == '__main__':
         authors_df = pd.DataFrame(rows)
         authors_df.sort_values(by='h-leadership-index', ascending=False, inplace=True)
 
-        # Store the metrics in a CSV file
-        store_dir = f'{results_dir}/{affiliation["affiliation"]}'
-        if not os.path.exists(store_dir):
-            os.makedirs(store_dir)
-        authors_df.to_csv(f'{store_dir}/metrics.csv', sep=',', index=False)
-        metric_summary(authors_df, 'h-leadership-index', store_dir)
-        correlation_analysis(authors_df, store_dir)
+        # Store the metrics in the results store, partitioned by affiliation
+        store.write_metrics(affiliation_name, authors_df)
+        store.write_summary(affiliation_name, metric_summary(authors_df, 'h-leadership-index'))
+        store.write_correlations(affiliation_name, authors_df[metric_columns(authors_df)].corr())
+        store.write(
+            'correlation_bootstrap', affiliation_name,
+            bootstrap_correlation(authors_df, method='spearman', n_bootstrap=1000, seed=0),
+            index_label='Other metric'
+        )
@@ -0,0 +1,211 @@
+'''
+Contains the collaboration index used to aggregate the co-authors of an author
+or a university by affiliation and country.
+'''
+import os
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from scopus import data_dir, affiliations, affiliation_scopus_details, external_affiliations_filepath, get_affiliation_details
+from utils import read_data, store_data
+
+
+class CollaborationIndex:
+    '''
+    An inverted index of collaborations built once from the author JSON files.
+
+    `author_affiliation` is a sparse author x affiliation matrix counting the
+    publications in which an author has a co-author from the affiliation.
+    `affiliation_country_matrix` is a sparse affiliation x country matrix resolved
+    through `scopus.get_affiliation_details`, so that the collaborations by
+    country are a single sparse product. The countries of affiliations missing
+    from the stored details are only fetched by `resolve_countries`. Refetched
+    authors only replace their own row.
+    '''
+    def __init__(self):
+        self.authors = dict() # scopus_id -> row
+        self.author_universities = list()
+        self.affiliations = dict() # affiliation_id -> column
+        self.countries = dict() # country -> column
+        self.affiliation_country = list() # country column per affiliation, -1 if unresolved
+        self.attempted = set() # affiliations already looked up
+        self.entries = dict() # row -> (affiliation columns, counts)
+        self._author_affiliation = None
+        self._affiliation_country = None
+
+    @classmethod
+    def from_data_dir(cls, directory=data_dir, universities=None, resolve=False):
+        '''
+        Build the index from the author JSON files stored per university, and
+        fetch the countries of the unknown affiliations if `resolve` is True.
+        '''
+        if universities is None:
+            universities = [affiliation['affiliation'] for affiliation in affiliations.values()]
+        index = cls()
+        for university in universities:
+            file_dir = f'{directory}/{university}'
+            for file in os.listdir(file_dir):
+                if file.endswith('.json'):
+                    index.add_author(read_data(f'{file_dir}/{file}'), university)
+        if resolve:
+            index.resolve_countries()
+        return index
+
+    def add_author(self, author, university=None):
+        '''
+        Add an author to the index or replace their collaborations if the
+        author was refetched.
+        '''
+        scopus_id = author['scopus_id']
+        if scopus_id not in self.authors:
+            self.authors[scopus_id] = len(self.authors)
+            self.author_universities.append(university)
+        row = self.authors[scopus_id]
+        if university is not None:
+            self.author_universities[row] = university
+
+        columns = []
+        for pub in author['publications']:
+            # Count every affiliation once per publication
+            pub_affiliations = {
+                affiliation_id
+                for coauthor in pub['authors'] if coauthor['scopus_id'] != scopus_id
+                for affiliation_id in coauthor['affiliation_id']
+            }
+            columns.extend(map(self._affiliation_column, pub_affiliations))
+        columns, counts = np.unique(np.array(columns, dtype=int), return_counts=True)
+        self.entries[row] = (columns, counts)
+        self._author_affiliation = None
+
+    def _affiliation_column(self, affiliation_id):
+        if affiliation_id not in self.affiliations:
+            self.affiliations[affiliation_id] = len(self.affiliations)
+            self.affiliation_country.append(-1)
+            # The cached matrix is missing the row of the new affiliation
+            self._affiliation_country = None
+            details = affiliation_scopus_details.get(affiliation_id)
+            if details:
+                self._set_country(affiliation_id, details.get('country'))
+        return self.affiliations[affiliation_id]
+
+    def _set_country(self, affiliation_id, country):
+        self.attempted.add(affiliation_id)
+        if country:
+            if country not in self.countries:
+                self.countries[country] = len(self.countries)
+            self.affiliation_country[self.affiliations[affiliation_id]] = self.countries[country]
+        self._affiliation_country = None
+
+    @property
+    def author_affiliation(self):
+        '''
+        The sparse author x affiliation count matrix.
+        '''
+        if self._author_affiliation is None:
+            rows = [np.full(len(columns), row) for row, (columns, _) in self.entries.items()]
+            columns = [columns for columns, _ in self.entries.values()]
+            counts = [counts for _, counts in self.entries.values()]
+            self._author_affiliation = sparse.csr_matrix(
+                (np.concatenate(counts or [[]]), (np.concatenate(rows or [[]]), np.concatenate(columns or [[]]))),
+                shape=(len(self.authors), len(self.affiliations)),
+                dtype=int
+            )
+        return self._author_affiliation
+
+    @property
+    def affiliation_country_matrix(self):
+        '''
+        The sparse affiliation x country matrix, empty rows for unresolved affiliations.
+        '''
+        if self._affiliation_country is None:
+            affiliation_country = np.array(self.affiliation_country, dtype=int)
+            resolved = np.flatnonzero(affiliation_country >= 0)
+            self._affiliation_country = sparse.csr_matrix(
+                (np.ones(len(resolved), dtype=int), (resolved, affiliation_country[resolved])),
+                shape=(len(self.affiliations), len(self.countries)),
+            )
+        return self._affiliation_country
+
+    def resolve_countries(self, scopus_id=None, university=None, save_every=50):
+        '''
+        Fetch the country of the affiliations not yet looked up, restricted to
+        the collaborations of an author or a university if given. Failed lookups
+        are retried on the next call. The fetched details are stored every
+        `save_every` affiliations, and the lookups stop at the Scopus rate limit.
+        '''
+        affiliation_ids = np.array(list(self.affiliations), dtype=object)
+        if scopus_id is not None or university is not None:
+            affiliation_ids = affiliation_ids[np.flatnonzero(self._collaborations(scopus_id, university))]
+        fetched = 0
+        try:
+            for affiliation_id in affiliation_ids:
+                if affiliation_id in self.attempted:
+                    continue
+                try:
+                    details = get_affiliation_details(affiliation_id, save=False)
+                except KeyError:
+                    # The affiliation exists but its details are missing the name or counts
+                    self._set_country(affiliation_id, None)
+                    continue
+                except Exception as e:
+                    print(e)
+                    break
+                if details is None:
+                    continue
+                self._set_country(affiliation_id, details.get('country'))
+                fetched += 1
+                if fetched % save_every == 0:
+                    store_data(affiliation_scopus_details, external_affiliations_filepath)
+        finally:
+            if fetched % save_every:
+                store_data(affiliation_scopus_details, external_affiliations_filepath)
+
+    def _collaborations(self, scopus_id=None, university=None):
+        if scopus_id is not None:
+            rows = [self.authors[scopus_id]]
+        else:
+            rows = [row for row, name in enumerate(self.author_universities) if name == university]
+        return np.asarray(self.author_affiliation[rows].sum(axis=0)).ravel()
+
+    def collaborations_by_affiliation(self, scopus_id=None, university=None):
+        '''
+        The number of collaborations per co-author affiliation id for an author
+        or for all the authors of a university.
+        '''
+        collaborations = self._collaborations(scopus_id, university)
+        columns = np.flatnonzero(collaborations)
+        affiliation_ids = np.array(list(self.affiliations), dtype=object)
+        return pd.Series(collaborations[columns], index=affiliation_ids[columns], name='Collaborations') \
+            .sort_values(ascending=False)
+
+    def collaborations_by_country(self, scopus_id=None, university=None):
+        '''
+        The number of collaborations per co-author country for an author or
+        for all the authors of a university. Only the affiliations whose country
+        is known are counted, see `resolve_countries`.
+        '''
+        collaborations = self._collaborations(scopus_id, university)
+        by_country = self.affiliation_country_matrix.T @ collaborations
+        return pd.Series(by_country, index=list(self.countries), name='Collaborations') \
+            .loc[lambda s: s > 0].sort_values(ascending=False)
+
+
+
+if __name__ == '__main__':
+    # Refetching an author with a new unknown affiliation must update the country queries
+    def author(affiliation_ids):
+        return {'scopus_id': '1', 'publications': [{'authors': [
+            {'scopus_id': '1', 'affiliation_id': []},
+            {'scopus_id': '2', 'affiliation_id': affiliation_ids},
+        ]}]}
+
+    index = CollaborationIndex()
+    index.add_author(author(['999999998']), 'University')
+    index._set_country('999999998', 'Australia') # As if resolved by `resolve_countries`
+    assert index.collaborations_by_country('1').to_dict() == {'Australia': 1}
+    index.add_author(author(['999999998', '999999999']), 'University')
+    assert index.collaborations_by_country('1').to_dict() == {'Australia': 1}
+    index._set_country('999999999', 'New Zealand')
+    assert index.collaborations_by_country(university='University').to_dict() == {'Australia': 1, 'New Zealand': 1}
+    print('Refetched authors update the collaborations by country')
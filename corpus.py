@@ -0,0 +1,153 @@
+'''
+Contains the compiler of the author JSON files into a flat binary corpus, and
+the computation of the metrics on memory-mapped views of it. Worker processes
+map the same files, so the publication data is shared instead of being parsed
+and copied by every worker.
+
+The corpus directory holds one fixed-width file per array:
+    citations.bin            int64, one per publication
+    num_authors.bin          int32, one per publication
+    author_ids.bin           int64, the author ids of every publication one after the other
+    author_offsets.bin       int64, publications + 1 offsets into author_ids
+    publication_offsets.bin  int64, authors + 1 offsets into the publications
+    scopus_ids.bin           int64, one per author
+    authors.json             the name, affiliation and university of every author
+'''
+import os
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from calculate import array_metrics
+from scopus import data_dir, affiliations
+from utils import read_data, store_data
+
+corpus_dir = f'{data_dir}/corpus'
+
+corpus_dtypes = {
+    'citations': np.int64,
+    'num_authors': np.int32,
+    'author_ids': np.int64,
+    'author_offsets': np.int64,
+    'publication_offsets': np.int64,
+    'scopus_ids': np.int64,
+}
+
+
+def compile_corpus(filepaths, directory=corpus_dir):
+    '''
+    Compile the author JSON files into the binary corpus. A file can hold one
+    author or a list of authors. The authors are appended one at a time, so
+    only a single file is in memory while compiling.
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = {name: open(f'{directory}/{name}.bin', 'wb') for name in corpus_dtypes}
+    authors = []
+    num_publications, num_author_ids = 0, 0
+    try:
+        files['author_offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+        files['publication_offsets'].write(np.zeros(1, dtype=np.int64).tobytes())
+        for filepath in filepaths:
+            data = read_data(filepath)
+            for author in (data if isinstance(data, list) else [data]):
+                pubs = author['publications']
+                num_authors = np.array([len(pub['authors']) for pub in pubs], dtype=np.int32)
+                author_ids = np.array([a['scopus_id'] for pub in pubs for a in pub['authors']], dtype=np.int64)
+                arrays = {
+                    'citations': np.array([int(pub['citations']) for pub in pubs], dtype=np.int64),
+                    'num_authors': num_authors,
+                    'author_ids': author_ids,
+                    'author_offsets': num_author_ids + np.cumsum(num_authors, dtype=np.int64),
+                    'publication_offsets': np.array([num_publications + len(pubs)], dtype=np.int64),
+                    'scopus_ids': np.array([author['scopus_id']], dtype=np.int64),
+                }
+                for name, array in arrays.items():
+                    files[name].write(array.astype(corpus_dtypes[name]).tobytes())
+                num_publications += len(pubs)
+                num_author_ids += len(author_ids)
+                authors.append({
+                    'name': author['name'],
+                    'affiliation': author.get('affiliation', ''),
+                    'university': os.path.basename(os.path.dirname(filepath)),
+                })
+    finally:
+        for file in files.values():
+            file.close()
+    store_data(authors, f'{directory}/authors.json')
+    return len(authors)
+
+
+def load_corpus(directory=corpus_dir):
+    '''
+    Memory-map the arrays of the corpus read only. Nothing is read from disk
+    until the arrays are used.
+    '''
+    corpus = dict()
+    for name, dtype in corpus_dtypes.items():
+        filepath = f'{directory}/{name}.bin'
+        if os.path.getsize(filepath) == 0:
+            corpus[name] = np.zeros(0, dtype=dtype)
+        else:
+            corpus[name] = np.memmap(filepath, dtype=dtype, mode='r')
+    corpus['authors'] = read_data(f'{directory}/authors.json')
+    return corpus
+
+
+def author_view(corpus, index):
+    '''
+    Views of the publications of the author at the index in the corpus, the
+    same arrays as `kernels.publication_arrays` returns for the author's JSON.
+    '''
+    start, end = corpus['publication_offsets'][index:index+2]
+    citations = corpus['citations'][start:end]
+    num_authors = corpus['num_authors'][start:end]
+    author_offsets = corpus['author_offsets'][start:end+1]
+    author_ids = corpus['author_ids'][author_offsets[0]:author_offsets[-1]]
+    return citations, num_authors, author_ids, author_offsets
+
+
+def corpus_metrics(corpus, index):
+    '''
+    The metrics of the author at the index in the corpus, the same as `calculate.metrics`.
+    '''
+    return array_metrics(corpus['authors'][index]['name'], str(corpus['scopus_ids'][index]), *author_view(corpus, index))
+
+
+# Corpus mapped by every worker process once
+worker_corpus = None
+
+def init_worker(directory):
+    global worker_corpus
+    worker_corpus = load_corpus(directory)
+
+def score_authors(indices):
+    return [corpus_metrics(worker_corpus, index) for index in indices]
+
+def score_corpus(directory=corpus_dir, n_jobs=None, chunksize=64):
+    '''
+    Calculate the metrics of every author in the corpus across a process pool.
+    Every worker memory-maps the corpus, so the page cache holds a single copy
+    of the data however many workers there are.
+    '''
+    num_authors = len(read_data(f'{directory}/authors.json'))
+    chunks = [range(start, min(start+chunksize, num_authors)) for start in range(0, num_authors, chunksize)]
+    if n_jobs == 1:
+        init_worker(directory)
+        rows = map(score_authors, chunks)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(directory,)) as executor:
+            rows = list(executor.map(score_authors, chunks))
+    return pd.DataFrame([row for chunk in rows for row in chunk])
+
+
+if __name__ == '__main__':
+    filepaths = [
+        f'{data_dir}/{affiliation["affiliation"]}/{file}'
+        for affiliation in affiliations.values()
+        for file in sorted(os.listdir(f'{data_dir}/{affiliation["affiliation"]}'))
+    ]
+    compile_corpus(filepaths)
+    authors_df = score_corpus()
+    authors_df.sort_values(by='h-leadership-index', ascending=False, inplace=True)
+    print(authors_df)
@@ -0,0 +1,352 @@
+'''
+Contains the array kernels of the h-index family and of the author position
+search, the interpreted loops of `metrics.py` rewritten on arrays. The kernels
+take, for the publications of one author, the citations, the number of
+authors and the position of the author in the author list (0 when missing),
+e.g. the views returned by `corpus.author_view`.
+
+The backends give identical results: `numba` compiles the loops when Numba is
+installed and `numpy` vectorises them otherwise, while `python` runs the loops
+interpreted. Select one with `set_backend`. Running this file checks every
+backend against `metrics.py` on synthetic authors covering the edge cases and
+times them, and checks the rows of `calculate.metrics` calculated with every
+backend against those calculated with `metrics.py`.
+'''
+import numpy as np
+
+from metrics import leadership_weight
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Leadership weight of the author positions 1..100, the positions beyond get the minimum weight
+ideal_max_authors = 100
+min_leadership_weight = 0.3
+leadership_weights = np.array([leadership_weight(author_position=p, n=2*ideal_max_authors) for p in range(1, ideal_max_authors+1)])
+
+
+# NumPy backend
+
+def h_index_numpy(citations):
+    ranked = np.sort(citations)[::-1]
+    return int((ranked >= np.arange(1, len(ranked)+1)).sum())
+
+
+def h_frac_index_numpy(citations, num_authors):
+    # Stable sort by citations like `list.sort`, the fractional citations need not be sorted
+    has_authors = num_authors > 0
+    citations, num_authors = citations[has_authors], num_authors[has_authors]
+    order = np.argsort(-citations, kind='stable')
+    met = citations[order] / num_authors[order] >= np.arange(1, len(order)+1)
+    return int(len(met) if met.all() else np.argmin(met))
+
+
+def hm_index_numpy(citations, num_authors):
+    has_authors = num_authors > 0
+    citations, num_authors = citations[has_authors], num_authors[has_authors]
+    order = np.argsort(-citations, kind='stable')
+    cumulative_weights = np.cumsum(1 / num_authors[order])
+    met = cumulative_weights <= citations[order]
+    num_met = len(met) if met.all() else np.argmin(met)
+    return int(cumulative_weights[num_met-1]) if num_met > 0 else 0
+
+
+def h_leadership_index_numpy(citations, num_authors, positions):
+    listed = (positions > 0) & (citations > 0)
+    positions, num_authors = positions[listed], num_authors[listed]
+    # Same weights for the first and last authors as `metrics.leadership_weight`
+    folded = np.where(positions > num_authors / 2, num_authors - positions + 1, positions)
+    weights = np.where(
+        folded > ideal_max_authors,
+        min_leadership_weight,
+        leadership_weights[np.clip(folded, 1, ideal_max_authors) - 1]
+    )
+    weighted_citations = np.sort(citations[listed] * weights)[::-1]
+    return int((weighted_citations >= np.arange(1, len(weighted_citations)+1)).sum())
+
+
+def author_positions_numpy(author_ids, author_offsets, scopus_id):
+    matches = np.flatnonzero(author_ids == scopus_id)
+    pub_indices = np.searchsorted(author_offsets, matches + author_offsets[0], side='right') - 1
+    # The first occurrence of the author in a publication, like `list.index`
+    pub_indices, first = np.unique(pub_indices, return_index=True)
+    positions = np.zeros(len(author_offsets) - 1, dtype=np.int64)
+    positions[pub_indices] = matches[first] + author_offsets[0] - author_offsets[pub_indices] + 1
+    return positions
+
+
+def median_author_position_numpy(positions):
+    positions = positions[positions > 0]
+    return float(np.median(positions)) if len(positions) else np.nan
+
+
+# Loops compiled by the Numba backend, the same as the loops of `metrics.py`
+
+def h_index_loop(citations):
+    ranked = np.sort(citations)[::-1]
+    h = 0
+    for i in range(len(ranked)):
+        if ranked[i] >= i + 1:
+            h = i + 1
+        else:
+            break
+    return h
+
+
+def h_frac_index_loop(citations, num_authors):
+    order = np.argsort(-citations, kind='mergesort')
+    h_frac = 0
+    i = 0
+    for j in order:
+        if num_authors[j] == 0:
+            continue
+        i += 1
+        if citations[j] / num_authors[j] >= i:
+            h_frac = i
+        else:
+            break
+    return h_frac
+
+
+def hm_index_loop(citations, num_authors):
+    order = np.argsort(-citations, kind='mergesort')
+    cumulative_weights = 0.0
+    hm = 0.0
+    for j in order:
+        if num_authors[j] == 0:
+            continue
+        cumulative_weights += 1 / num_authors[j]
+        if cumulative_weights <= citations[j]:
+            hm = cumulative_weights
+        else:
+            break
+    return int(hm)
+
+
+def h_leadership_index_loop(citations, num_authors, positions, weights):
+    weighted_citations = np.zeros(len(citations))
+    count = 0
+    for j in range(len(citations)):
+        if positions[j] == 0 or citations[j] == 0:
+            continue
+        position = positions[j]
+        if position > num_authors[j] / 2:
+            position = num_authors[j] - position + 1
+        l_weight = min_leadership_weight if position > ideal_max_authors else weights[position-1]
+        weighted_citations[count] = citations[j] * l_weight
+        count += 1
+    ranked = np.sort(weighted_citations[:count])[::-1]
+    h_leadership = 0
+    for i in range(count):
+        if ranked[i] >= i + 1:
+            h_leadership = i + 1
+        else:
+            break
+    return h_leadership
+
+
+def author_positions_loop(author_ids, author_offsets, scopus_id):
+    positions = np.zeros(len(author_offsets) - 1, dtype=np.int64)
+    for pub in range(len(positions)):
+        for k in range(author_offsets[pub], author_offsets[pub+1]):
+            if author_ids[k - author_offsets[0]] == scopus_id:
+                positions[pub] = k - author_offsets[pub] + 1
+                break
+    return positions
+
+
+def median_author_position_loop(positions):
+    found = positions[positions > 0]
+    if len(found) == 0:
+        return np.nan
+    return np.median(found)
+
+
+backends = {
+    'python': {
+        'h_index': h_index_loop,
+        'h_frac_index': h_frac_index_loop,
+        'hm_index': hm_index_loop,
+        'h_leadership_index': lambda citations, num_authors, positions:
+            h_leadership_index_loop(citations, num_authors, positions, leadership_weights),
+        'author_positions': author_positions_loop,
+        'median_author_position': median_author_position_loop,
+    },
+    'numpy': {
+        'h_index': h_index_numpy,
+        'h_frac_index': h_frac_index_numpy,
+        'hm_index': hm_index_numpy,
+        'h_leadership_index': h_leadership_index_numpy,
+        'author_positions': author_positions_numpy,
+        'median_author_position': median_author_position_numpy,
+    },
+}
+if numba is not None:
+    compiled_h_leadership_index = numba.njit(cache=True)(h_leadership_index_loop)
+    backends['numba'] = {
+        'h_index': numba.njit(cache=True)(h_index_loop),
+        'h_frac_index': numba.njit(cache=True)(h_frac_index_loop),
+        'hm_index': numba.njit(cache=True)(hm_index_loop),
+        'h_leadership_index': lambda citations, num_authors, positions:
+            compiled_h_leadership_index(citations, num_authors, positions, leadership_weights),
+        'author_positions': numba.njit(cache=True)(author_positions_loop),
+        'median_author_position': numba.njit(cache=True)(median_author_position_loop),
+    }
+
+backend = 'numba' if numba is not None else 'numpy'
+
+
+def set_backend(name):
+    '''
+    Select the backend of the kernels, `numba`, `numpy` or `python`.
+    '''
+    global backend
+    if name not in backends:
+        raise ValueError(f'Backend {name} is not available, choose from {list(backends)}')
+    backend = name
+
+
+def h_index(citations):
+    return int(backends[backend]['h_index'](np.asarray(citations)))
+
+
+def h_frac_index(citations, num_authors):
+    return int(backends[backend]['h_frac_index'](np.asarray(citations), np.asarray(num_authors)))
+
+
+def hm_index(citations, num_authors):
+    return int(backends[backend]['hm_index'](np.asarray(citations), np.asarray(num_authors)))
+
+
+def h_leadership_index(citations, num_authors, positions):
+    return int(backends[backend]['h_leadership_index'](np.asarray(citations), np.asarray(num_authors), np.asarray(positions)))
+
+
+def author_positions(author_ids, author_offsets, scopus_id):
+    '''
+    The position of the author in the author list of every publication, 0 when
+    missing. `author_ids` holds the author ids of the publications one after
+    the other, starting at `author_offsets[0]`.
+    '''
+    return backends[backend]['author_positions'](np.asarray(author_ids), np.asarray(author_offsets), scopus_id)
+
+
+def median_author_position(positions):
+    return float(backends[backend]['median_author_position'](np.asarray(positions)))
+
+
+def publication_arrays(author):
+    '''
+    The kernel inputs of an author read from JSON.
+    '''
+    pubs = author['publications']
+    citations = np.array([int(pub['citations']) for pub in pubs], dtype=np.int64)
+    num_authors = np.array([len(pub['authors']) for pub in pubs], dtype=np.int64)
+    author_ids = np.array([a['scopus_id'] for pub in pubs for a in pub['authors']], dtype=np.int64)
+    author_offsets = np.concatenate([[0], np.cumsum(num_authors)])
+    return citations, num_authors, author_ids, author_offsets
+
+
+if __name__ == '__main__':
+    import time
+    import warnings
+    import metrics
+
+    # Means of empty lists warn in `metrics.py` and in the kernels alike
+    warnings.simplefilter('ignore', RuntimeWarning)
+
+    def publication(citations, authors):
+        return {'citations': citations, 'authors': [{'scopus_id': str(a)} for a in authors]}
+
+    scopus_id = 7
+    others = lambda n: [1000 + i for i in range(n)]
+    cases = {
+        'no publications': [],
+        'zero-author papers': [publication(50, []), publication(30, [scopus_id]), publication(0, [])],
+        'citation ties': [publication(c, [scopus_id] + others(i % 4)) for i, c in enumerate([9, 9, 9, 5, 5, 5, 5, 2, 2, 0, 0])],
+        'author missing': [publication(c, others(3)) for c in [40, 20, 10]],
+        'author missing from some': [publication(40, others(3)), publication(20, [scopus_id]), publication(10, others(2) + [scopus_id])],
+        'author listed twice': [publication(12, [scopus_id] + others(2) + [scopus_id]), publication(8, others(1) + [scopus_id, scopus_id])],
+        'positions beyond 100': [
+            publication(c, others(position - 1) + [scopus_id] + others(n - position))
+            for c, position, n in [(500, 120, 250), (400, 150, 250), (300, 101, 202), (200, 200, 250), (100, 99, 300)]
+        ],
+    }
+    # Random authors for the timings, with some long author lists
+    rng = np.random.default_rng(0)
+    for i in range(200):
+        pubs = []
+        for _ in range(rng.integers(0, 300)):
+            n = int(rng.choice([0, 1, 2, 5, 10, 150]))
+            position = int(rng.integers(0, n + 1))
+            authors = others(n)
+            if position:
+                authors[position - 1] = scopus_id
+            pubs.append(publication(int(rng.pareto(1) * 10), authors))
+        cases[f'random {i}'] = pubs
+
+    authors = [{'name': name, 'scopus_id': str(scopus_id), 'publications': pubs} for name, pubs in cases.items()]
+    arrays = [publication_arrays(author) for author in authors]
+
+    references = {
+        'h_index': lambda author: metrics.h_index(author['publications']),
+        'h_frac_index': lambda author: metrics.h_frac_index(author['publications']),
+        'hm_index': lambda author: metrics.hm_index(author['publications']),
+        'h_leadership_index': lambda author: metrics.h_leadership_index(author['scopus_id'], author['publications']),
+        'median_author_position': lambda author: metrics.median_author_position(author['scopus_id'], author['publications']),
+    }
+
+    def kernel_calls(citations, num_authors, author_ids, author_offsets):
+        positions = author_positions(author_ids, author_offsets, scopus_id)
+        return {
+            'h_index': lambda: h_index(citations),
+            'h_frac_index': lambda: h_frac_index(citations, num_authors),
+            'hm_index': lambda: hm_index(citations, num_authors),
+            'h_leadership_index': lambda: h_leadership_index(citations, num_authors, positions),
+            'median_author_position': lambda: median_author_position(
+                author_positions(author_ids, author_offsets, scopus_id)
+            ),
+        }
+
+    timings = {kernel: {} for kernel in references}
+    for kernel, reference in references.items():
+        start = time.perf_counter()
+        expected = [reference(author) for author in authors]
+        timings[kernel]['metrics.py'] = time.perf_counter() - start
+
+        for name in backends:
+            set_backend(name)
+            calls = [kernel_calls(*author_arrays)[kernel] for author_arrays in arrays]
+            calls[0]() # Compile before timing
+            start = time.perf_counter()
+            results = [call() for call in calls]
+            timings[kernel][name] = time.perf_counter() - start
+            # Parity with `metrics.py`, where both are missing the median position is NaN
+            mismatches = [
+                author['name'] for author, result, value in zip(authors, results, expected)
+                if not (result == value or (np.isnan(result) and np.isnan(value)))
+            ]
+            assert not mismatches, f'{name} {kernel} differs from metrics.py for {mismatches}'
+
+    # The rows of `calculate.metrics`, including the columns calculated outside the kernels
+    import pandas as pd
+    import calculate
+
+    calculate.use_kernels = False
+    expected_rows = []
+    for author in authors:
+        calculate.metrics(author, expected_rows)
+    calculate.use_kernels = True
+    for name in backends:
+        set_backend(name)
+        rows = []
+        for author in authors:
+            calculate.metrics(author, rows)
+        pd.testing.assert_frame_equal(pd.DataFrame(rows), pd.DataFrame(expected_rows), obj=f'{name} rows')
+
+    print(f'Parity with metrics.py checked on {len(authors)} synthetic authors')
+    print('Seconds per kernel over all authors:')
+    for kernel, kernel_timings in timings.items():
+        print(f'{kernel:>24}: ' + ', '.join(f'{name} {seconds:.4f}' for name, seconds in kernel_timings.items()))
@@ -0,0 +1,150 @@
+'''
+Contains the streaming pipeline which fetches the authors of every affiliation
+and calculates their metrics as soon as their publications arrive, instead of
+fetching everything with `scopus.py` before running `calculate.py`.
+
+Fetcher threads put the authors on a bounded queue, which the main thread
+consumes to calculate the metrics and append them to the results store. The
+metrics are calculated while the fetchers wait on the Scopus API, and the rows
+stored so far can be queried while the harvest is still running.
+'''
+import pandas as pd
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from calculate import metrics, metric_summary, metric_columns
+from results_store import ResultsStore
+from scopus import data_dir, affiliations, fetch_author
+from summary import SummaryStatistics
+from utils import get_author_names, store_data
+
+
+def staging_partition(affiliation_name):
+    '''
+    The partition holding the results of the affiliation while it is harvested.
+    '''
+    return f'{affiliation_name} (staging)'
+
+
+def put_until_stopped(authors_queue, item, stop, timeout=1):
+    '''
+    Put the item on the queue, blocking while the queue is full unless the
+    pipeline is stopped. Returns whether the item was put.
+    '''
+    while not stop.is_set():
+        try:
+            authors_queue.put(item, timeout=timeout)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def fetch_into_queue(affiliation, author_name, authors_queue, stop, store_dir=None):
+    '''
+    Fetch an author of the affiliation and put them on the queue. Failures are
+    recorded like `scopus.fetch_authors_by_affiliation`.
+    '''
+    if stop.is_set():
+        return
+    affiliation_name = affiliation['affiliation']
+    try:
+        first_name, last_name = get_author_names(author_name, separator=' ', reverse=False)
+        author = fetch_author(
+            first_name=first_name,
+            last_name=last_name,
+            affiliation=affiliation_name,
+            country=affiliation['country'],
+        )
+        if store_dir:
+            store_data(author, f'{store_dir}/{affiliation_name}/{author["scopus_id"]}.json')
+    except Exception as e:
+        print(e)
+        with open(f'{data_dir}/failures.txt', 'a') as f:
+            f.write(f'{affiliation_name}: {author_name}\n')
+        return
+    put_until_stopped(authors_queue, (affiliation_name, author), stop)
+
+
+def run_pipeline(affiliations=list(affiliations.values()), store=None, num_fetchers=4, queue_size=16, store_dir=data_dir):
+    '''
+    Fetch the authors of the affiliations and store their metrics as they
+    arrive. The summary of every affiliation is updated with every author and
+    the correlations are stored once all its authors are in. The results are
+    streamed into a staging partition of every affiliation, which replaces its
+    previous results once the harvest is complete. If storing fails or the run
+    is interrupted, the fetchers are stopped before re-raising and the previous
+    results are kept.
+    '''
+    if store is None:
+        store = ResultsStore()
+    staging = {affiliation['affiliation']: staging_partition(affiliation['affiliation']) for affiliation in affiliations}
+    # Partial results of an aborted run
+    for partition in staging.values():
+        for table in ('metrics', 'summaries', 'correlations'):
+            store.delete(table, partition)
+
+    authors_queue = Queue(maxsize=queue_size)
+    stop = Event()
+    executor = ThreadPoolExecutor(max_workers=num_fetchers)
+
+    def produce():
+        try:
+            futures = {
+                executor.submit(fetch_into_queue, affiliation, author_name, authors_queue, stop, store_dir): author_name
+                for affiliation in affiliations
+                for author_name in affiliation['researchers']
+            }
+            # Not `as_completed`, which never yields the futures cancelled by the shutdown
+            for future, author_name in futures.items():
+                try:
+                    future.result()
+                except CancelledError:
+                    break
+                except Exception as e:
+                    print(f'Error fetching author: {author_name}: {e}')
+        finally:
+            # Signal the end of the harvest
+            put_until_stopped(authors_queue, None, stop)
+
+    producer = Thread(target=produce, daemon=True)
+    producer.start()
+
+    affiliation_rows = {affiliation['affiliation']: [] for affiliation in affiliations}
+    summaries = {affiliation['affiliation']: SummaryStatistics() for affiliation in affiliations}
+    try:
+        while (item := authors_queue.get()) is not None:
+            affiliation_name, author = item
+            rows = []
+            try:
+                metrics(author, rows)
+            except Exception as e:
+                print(f"Error processing author: {author['name']}: {e}")
+                continue
+            store.append('metrics', staging[affiliation_name], rows)
+            affiliation_rows[affiliation_name].extend(rows)
+            summaries[affiliation_name].update(rows)
+            store.write_summary(staging[affiliation_name], metric_summary(summaries[affiliation_name], 'h-leadership-index'))
+    finally:
+        # Stop the fetchers and unblock those waiting on a full queue
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try:
+                authors_queue.get_nowait()
+            except Empty:
+                break
+    producer.join()
+
+    for affiliation_name, rows in affiliation_rows.items():
+        if not rows:
+            continue
+        authors_df = pd.DataFrame(rows)
+        store.write_correlations(staging[affiliation_name], authors_df[metric_columns(authors_df)].corr())
+        store.swap(staging[affiliation_name], affiliation_name)
+    return store
+
+
+if __name__ == '__main__':
+    run_pipeline()
@@ -0,0 +1,209 @@
+'''
+Contains the results store, a single SQLite database holding the metrics,
+summaries and correlations of every affiliation. Every table has an
+`Affiliation` column which partitions it, so that an affiliation can be
+rewritten on its own and queried across affiliations without re-reading CSVs.
+'''
+import os
+import sqlite3
+import pandas as pd
+
+results_dir = 'results'
+results_db_filepath = f'{results_dir}/results.db'
+
+# Aggregates computed by SQLite for the cross-affiliation queries
+aggregate_functions = {'mean': 'AVG', 'min': 'MIN', 'max': 'MAX', 'sum': 'SUM', 'count': 'COUNT'}
+
+
+class ResultsStore:
+    '''
+    A queryable store of the results partitioned by affiliation.
+    '''
+    def __init__(self, filepath=results_db_filepath):
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Readers can query the store while a run is still writing to it
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def close(self):
+        self.connection.close()
+
+    def tables(self):
+        return [name for name, in self.connection.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+    def columns(self, table):
+        return [row[1] for row in self.connection.execute(f'PRAGMA table_info("{table}")')]
+
+    def affiliations(self, table='metrics'):
+        if table not in self.tables():
+            return []
+        return [name for name, in self.connection.execute(f'SELECT DISTINCT Affiliation FROM "{table}" ORDER BY Affiliation')]
+
+    def _metric(self, table, metric):
+        if metric not in self.columns(table):
+            raise KeyError(f'{metric} not found in {table}')
+        return f'"{metric}"'
+
+    def _insert(self, table, df):
+        # Tables gain the columns of newly written metrics instead of rejecting the rows
+        if table in self.tables():
+            for column in df.columns.difference(self.columns(table), sort=False):
+                self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}"')
+        df.to_sql(table, self.connection, if_exists='append', index=False)
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_affiliation" ON "{table}" (Affiliation)')
+        if 'Scopus ID' in df.columns:
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{table}_scopus_id" ON "{table}" ("Scopus ID")')
+
+    def write(self, table, affiliation, df, index_label=None):
+        '''
+        Replace the partition of the affiliation in the table with the DataFrame.
+        '''
+        if index_label:
+            df = df.rename_axis(index_label).reset_index()
+        df = df.assign(Affiliation=affiliation)
+        with self.connection:
+            if table in self.tables():
+                self.connection.execute(f'DELETE FROM "{table}" WHERE Affiliation = ?', (affiliation,))
+            self._insert(table, df)
+
+    def delete(self, table, affiliation):
+        '''
+        Remove the partition of the affiliation from the table.
+        '''
+        if table in self.tables():
+            with self.connection:
+                self.connection.execute(f'DELETE FROM "{table}" WHERE Affiliation = ?', (affiliation,))
+
+    def swap(self, staging, affiliation, tables=('metrics', 'summaries', 'correlations')):
+        '''
+        Replace the partitions of the affiliation with the staging partitions
+        in one transaction, so that readers see either the previous or the new
+        results of the affiliation.
+        '''
+        with self.connection:
+            for table in tables:
+                if table in self.tables():
+                    self.connection.execute(f'DELETE FROM "{table}" WHERE Affiliation = ?', (affiliation,))
+                    self.connection.execute(f'UPDATE "{table}" SET Affiliation = ? WHERE Affiliation = ?', (affiliation, staging))
+
+    def append(self, table, affiliation, rows):
+        '''
+        Append rows to the partition of the affiliation in the table.
+        '''
+        df = pd.DataFrame(rows).assign(Affiliation=affiliation)
+        with self.connection:
+            self._insert(table, df)
+
+    def read(self, table, affiliation=None):
+        '''
+        Read the table, restricted to an affiliation or a list of affiliations.
+        '''
+        if affiliation is None:
+            return pd.read_sql(f'SELECT * FROM "{table}"', self.connection)
+        affiliations = [affiliation] if isinstance(affiliation, str) else list(affiliation)
+        placeholders = ', '.join('?' * len(affiliations))
+        return pd.read_sql(f'SELECT * FROM "{table}" WHERE Affiliation IN ({placeholders})', self.connection, params=affiliations)
+
+    def write_metrics(self, affiliation, authors_df):
+        self.write('metrics', affiliation, authors_df)
+
+    def write_summary(self, affiliation, summary):
+        '''
+        Store the summary statistics of a metric as returned by `calculate.metric_summary`.
+        '''
+        summary_df = summary.to_frame().T.rename_axis('Metric').reset_index().assign(Affiliation=affiliation)
+        with self.connection:
+            if 'summaries' in self.tables():
+                self.connection.execute('DELETE FROM summaries WHERE Affiliation = ? AND Metric = ?', (affiliation, summary.name))
+            self._insert('summaries', summary_df)
+
+    def write_correlations(self, affiliation, correlation_matrix, method='pearson'):
+        '''
+        Store the correlation matrix of the metrics in long format.
+        '''
+        correlations = correlation_matrix.rename_axis('Metric').reset_index() \
+            .melt(id_vars='Metric', var_name='Other metric', value_name='Correlation') \
+            .assign(Method=method, Affiliation=affiliation)
+        with self.connection:
+            if 'correlations' in self.tables():
+                self.connection.execute('DELETE FROM correlations WHERE Affiliation = ? AND Method = ?', (affiliation, method))
+            self._insert('correlations', correlations)
+
+    def metrics(self, affiliation=None):
+        return self.read('metrics', affiliation)
+
+    def top_k(self, metric, k=10, affiliation=None, ascending=False):
+        '''
+        The top `k` authors by the metric within an affiliation or across all of them.
+        '''
+        metric = self._metric('metrics', metric)
+        query = 'SELECT * FROM metrics'
+        params = []
+        if affiliation is not None:
+            query += ' WHERE Affiliation = ?'
+            params.append(affiliation)
+        query += f' ORDER BY {metric} {"ASC" if ascending else "DESC"} LIMIT ?'
+        return pd.read_sql(query, self.connection, params=params + [k])
+
+    def percentile_rank(self, scopus_id, metric, affiliation=None, within=True):
+        '''
+        The percentage of authors whose metric is at most the author's, ranked
+        within the affiliation unless `within` is False, in which case every
+        author is counted once across all affiliations. The affiliation is
+        required when the author is stored in more than one, e.g. `top_2pc`
+        and their university. Legacy results imported with `import_csv` have
+        no Scopus ID, so their authors can't be ranked.
+        '''
+        if 'Scopus ID' not in self.columns('metrics'):
+            raise KeyError('Scopus ID not found in metrics, the authors of results imported from CSV can\'t be ranked')
+        metric = self._metric('metrics', metric)
+        query = f'SELECT {metric}, Affiliation FROM metrics WHERE "Scopus ID" = ?'
+        params = [str(scopus_id)]
+        if affiliation is not None:
+            query += ' AND Affiliation = ?'
+            params.append(affiliation)
+        rows = self.connection.execute(query, params).fetchall()
+        if not rows:
+            raise KeyError(f'Author {scopus_id} not found' + (f' in {affiliation}' if affiliation else ''))
+        if len(rows) > 1:
+            raise ValueError(f'Author {scopus_id} is stored in {sorted(row[1] for row in rows)}, choose the affiliation')
+        value, author_affiliation = rows[0]
+
+        if within:
+            query = f'SELECT 100.0 * SUM({metric} <= ?) / COUNT({metric}) FROM metrics WHERE Affiliation = ?'
+            params = [value, author_affiliation]
+        else:
+            # The last stored row of every author, so that authors stored in several affiliations count once
+            query = f'''SELECT 100.0 * SUM({metric} <= ?) / COUNT({metric}) FROM metrics
+                WHERE rowid IN (SELECT MAX(rowid) FROM metrics WHERE "Scopus ID" IS NOT NULL GROUP BY "Scopus ID")'''
+            params = [value]
+        return self.connection.execute(query, params).fetchone()[0]
+
+    def aggregate(self, metrics=None, agg='mean'):
+        '''
+        Aggregate the metrics of the authors of every affiliation, one row per affiliation.
+        '''
+        if metrics is None:
+            metrics = [col for col in self.columns('metrics') if col not in ('Name', 'Scopus ID', 'Affiliation')]
+        selected = ', '.join(f'{aggregate_functions[agg]}({self._metric("metrics", m)}) AS "{m}"' for m in metrics)
+        return pd.read_sql(f'SELECT Affiliation, {selected} FROM metrics GROUP BY Affiliation', self.connection) \
+            .set_index('Affiliation')
+
+    def import_csv(self, directory=results_dir):
+        '''
+        Load the per affiliation CSV results written by previous runs of `calculate.py`.
+        '''
+        for affiliation in sorted(os.listdir(directory)):
+            metrics_filepath = f'{directory}/{affiliation}/metrics.csv'
+            if not os.path.exists(metrics_filepath):
+                continue
+            self.write_metrics(affiliation, pd.read_csv(metrics_filepath))
+            correlation_filepath = f'{directory}/{affiliation}/correlation_matrix.csv'
+            if os.path.exists(correlation_filepath):
+                self.write_correlations(affiliation, pd.read_csv(correlation_filepath, index_col=0))
+            for file in os.listdir(f'{directory}/{affiliation}'):
+                if file.startswith('h_leadership'):
+                    summary = pd.read_csv(f'{directory}/{affiliation}/{file}', index_col=0).iloc[:, 0]
+                    self.write_summary(affiliation, summary)
@@ -144,7 +144,8 @@ def fetch_author_publications(author_id, publications=None, start_index=0):
         if start_index < int(response.json().get('search-results', {}).get('opensearch:totalResults', 0)):
             return fetch_author_publications(author_id, publications, start_index)
     else:
-        print(response.json())
+        # A missing page would silently truncate the author's publications
+        raise Exception(f'Fetching publications of author {author_id} failed at {start_index}: {response.status_code} {response.text}')
 
     return publications
 
@@ -0,0 +1,191 @@
+'''
+Contains mergeable summary statistics of the metrics, for populations too large
+to hold as one DataFrame. Every worker or streaming run can update its own
+summary and the summaries can then be merged into one.
+
+The count, mean and variance are exact (up to floating point) using Welford's
+algorithm and Chan's formula to merge them. The min and max are exact. The
+quantiles are estimated with a KLL sketch whose rank error shrinks with `k`:
+it is about 1% for the default `k=200`. While fewer than `k` values have been
+added the sketch holds all of them and the quantiles are exact.
+'''
+import math
+import random
+import zlib
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Union
+
+
+class KLLSketch:
+    '''
+    A KLL quantile sketch. Level `h` holds items standing for `2**h` values each.
+    A full level is sorted and every other item is promoted to the next level,
+    starting at a random offset so that the ranks are unbiased.
+    '''
+    def __init__(self, k=200, c=2/3, seed=None):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.compactors = [[]]
+        self.random = random.Random(seed)
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * self.c**depth)) + 1
+
+    def size(self):
+        return sum(len(compactor) for compactor in self.compactors)
+
+    def max_size(self):
+        return sum(self.capacity(level) for level in range(len(self.compactors)))
+
+    def update(self, values):
+        values = [float(v) for v in np.atleast_1d(values) if not np.isnan(v)]
+        self.compactors[0].extend(values)
+        self.n += len(values)
+        self.compress()
+
+    def compress(self):
+        while self.size() >= self.max_size():
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) >= self.capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    compactor.sort()
+                    # An odd item out stays at its level
+                    keep = [compactor.pop()] if len(compactor) % 2 else []
+                    self.compactors[level+1].extend(compactor[self.random.randint(0, 1)::2])
+                    self.compactors[level] = keep
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.n += other.n
+        self.compress()
+        return self
+
+    def quantile(self, q):
+        '''
+        The q-th quantile, with linear interpolation like `DataFrame.describe`
+        while the sketch is exact.
+        '''
+        if self.n == 0:
+            return np.nan
+        if len(self.compactors) == 1:
+            return float(np.quantile(self.compactors[0], q))
+        values = np.concatenate([np.array(compactor, dtype=float) for compactor in self.compactors])
+        weights = np.concatenate([np.full(len(compactor), 2**level) for level, compactor in enumerate(self.compactors)])
+        order = np.argsort(values, kind='stable')
+        cumulative_weights = np.cumsum(weights[order])
+        # The first item whose rank covers the requested one
+        index = np.searchsorted(cumulative_weights, q * cumulative_weights[-1], side='left')
+        return float(values[order][min(index, len(values) - 1)])
+
+
+class MetricSummary:
+    '''
+    Mergeable count, mean, variance, min, max and quantiles of one metric.
+    Missing values are ignored like `DataFrame.describe`.
+    '''
+    def __init__(self, k=200, seed=None):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0 # Sum of the squared differences from the mean
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = KLLSketch(k=k, seed=seed)
+
+    def _combine(self, count, mean, m2):
+        # Chan et al. parallel update of the mean and the squared differences
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    def update(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self._combine(len(values), values.mean(), ((values - values.mean())**2).sum())
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.sketch.update(values)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        self._combine(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def describe(self, percentiles=(0.25, 0.5, 0.75)):
+        stats = {
+            'count': float(self.count),
+            'mean': self.mean if self.count else np.nan,
+            'std': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan,
+            'min': self.min if self.count else np.nan,
+        }
+        for q in percentiles:
+            stats[f'{q*100:g}%'] = self.sketch.quantile(q)
+        stats['max'] = self.max if self.count else np.nan
+        return pd.Series(stats)
+
+
+class SummaryStatistics:
+    '''
+    The mergeable summaries of every metric column of the author rows, as
+    produced by `calculate.metrics`. Non-numeric columns such as the name are
+    skipped.
+
+    The seed is an int or a `np.random.SeedSequence`. Every metric draws its
+    compaction offsets from its own child of the seed, and the summaries of
+    the workers should come from `spawn` so that their sketches differ too.
+    '''
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.summaries: Dict[str, MetricSummary] = dict()
+
+    def spawn(self, n):
+        '''
+        Empty summaries with independent seeds, one for every worker.
+        '''
+        return [SummaryStatistics(k=self.k, seed=child) for child in self.seed.spawn(n)]
+
+    def _metric_seed(self, metric):
+        # Keyed by the metric name rather than spawned, so the seed does not depend on the column order
+        child = np.random.SeedSequence(self.seed.entropy, spawn_key=self.seed.spawn_key + (zlib.crc32(str(metric).encode()),))
+        return int(child.generate_state(1, dtype=np.uint64)[0])
+
+    def _summary(self, metric):
+        if metric not in self.summaries:
+            self.summaries[metric] = MetricSummary(k=self.k, seed=self._metric_seed(metric))
+        return self.summaries[metric]
+
+    def update(self, rows: Union[pd.DataFrame, List[Dict], Dict]):
+        if isinstance(rows, dict):
+            rows = [rows]
+        authors_df = pd.DataFrame(rows).select_dtypes(include='number')
+        for metric in authors_df.columns:
+            self._summary(metric).update(authors_df[metric].to_numpy())
+        return self
+
+    def merge(self, other):
+        for metric, summary in other.summaries.items():
+            self._summary(metric).merge(summary)
+        return self
+
+    def describe(self, metric):
+        '''
+        The summary of the metric in the format of `Series.describe`.
+        '''
+        return self.summaries[metric].describe().rename(metric)
@@ -0,0 +1,191 @@
+'''
+Time-windowed metrics computed from the `cover_date` of an author's publications.
+The citations of a publication are its current citation count, so a window
+selects the publications by their year of publication.
+'''
+import numpy as np
+import pandas as pd
+
+from functools import lru_cache
+from typing import List
+from metrics import leadership_weight
+
+cached_leadership_weight = lru_cache(maxsize=None)(leadership_weight)
+
+
+def publication_year(publication):
+    '''
+    The year of a publication from its cover date, None if it is missing.
+    '''
+    try:
+        return int(publication['cover_date'][:4])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class ThresholdCounts:
+    '''
+    Cumulative counts of an author's publications up to every year whose value
+    is at least `t`, for every threshold `t` up to the author's own career
+    h-type index, which bounds the index of every window. Each author's block
+    spans only the years from their first to their last publication and their
+    own thresholds, so one high-h author does not grow everyone's block. The
+    blocks are stored one after the other in a flat array, where
+    `counts[offset + r*h + t-1]` counts the publications up to the author's
+    year row `r` with a value of at least `t`.
+    '''
+    def __init__(self, author_rows, year_rows, values, num_authors):
+        order = np.lexsort((year_rows, author_rows))
+        author_rows, year_rows, values = author_rows[order], year_rows[order], values[order]
+        bounds = np.searchsorted(author_rows, np.arange(num_authors+1))
+
+        self.num_authors = num_authors
+        self.h = np.zeros(num_authors, dtype=np.int64)
+        self.first_rows = np.ones(num_authors, dtype=np.int64)
+        self.spans = np.zeros(num_authors, dtype=np.int64)
+        blocks = []
+        for row in range(num_authors):
+            years, author_values = year_rows[bounds[row]:bounds[row+1]], values[bounds[row]:bounds[row+1]]
+            ranked = np.sort(author_values)[::-1]
+            h = int((ranked >= np.arange(1, len(ranked)+1)).sum())
+            if h == 0:
+                continue
+            first_row = years[0]
+            span = years[-1] - first_row + 1
+            # Histogram the values clipped to the largest threshold, then sum them in reverse and over the years
+            counts = np.zeros((span+1, h+1), dtype=np.int32)
+            np.add.at(counts, (years - first_row + 1, np.clip(author_values, 0, h)), 1)
+            counts = np.cumsum(np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:], axis=0, dtype=np.int32)
+            blocks.append(counts.ravel())
+            self.h[row], self.first_rows[row], self.spans[row] = h, first_row, span
+
+        self.counts = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int32)
+        offsets = np.concatenate([[0], np.cumsum((self.spans + 1) * self.h)])
+        # One entry per author and threshold
+        self.entry_authors = np.repeat(np.arange(num_authors), self.h)
+        self.entry_strides = np.repeat(self.h, self.h)
+        self.entry_thresholds = np.arange(len(self.entry_authors)) - np.repeat(np.cumsum(self.h) - self.h, self.h)
+        self.entry_offsets = np.repeat(offsets[:-1], self.h) + self.entry_thresholds
+
+    def _entry_rows(self, cumulative_index):
+        # An author's year row covering the same years as the population's cumulative year index
+        return np.repeat(np.clip(cumulative_index - self.first_rows + 1, 0, self.spans), self.h)
+
+    def window_h(self, start, end):
+        '''
+        The h-type index of every author between the cumulative year indices
+        `start` (exclusive) and `end` (inclusive) of the population.
+        '''
+        window_counts = self.counts[self.entry_offsets + self._entry_rows(end) * self.entry_strides] \
+            - self.counts[self.entry_offsets + self._entry_rows(start) * self.entry_strides]
+        # The counts decrease with the threshold so the index is the number of thresholds met
+        met = window_counts >= self.entry_thresholds + 1
+        return np.bincount(self.entry_authors, weights=met, minlength=self.num_authors).astype(int)
+
+
+class PublicationTimeline:
+    '''
+    Year-bucketed cumulative arrays of the publications of every author,
+    precomputed once so that any window of years is a difference of two
+    cumulative lookups for all the authors at once. The first year bucket is
+    empty so that a window starting at the first year needs no special case.
+    Publications without a cover date are ignored.
+    '''
+    def __init__(self, authors: List):
+        self.scopus_ids = [author['scopus_id'] for author in authors]
+        author_rows, years, citations, leadership_citations = [], [], [], []
+        for row, author in enumerate(authors):
+            for pub in author['publications']:
+                year = publication_year(pub)
+                if year is None:
+                    continue
+                author_ids = list(map(lambda x: x['scopus_id'], pub['authors']))
+                l_citations = 0
+                if int(pub['citations']) > 0 and author['scopus_id'] in author_ids:
+                    l_weight = cached_leadership_weight(author_position=author_ids.index(author['scopus_id'])+1, n=len(author_ids))
+                    l_citations = int(pub['citations']) * l_weight
+                author_rows.append(row)
+                years.append(year)
+                citations.append(int(pub['citations']))
+                leadership_citations.append(l_citations)
+
+        author_rows = np.array(author_rows, dtype=int)
+        years = np.array(years, dtype=int)
+        citations = np.array(citations, dtype=int)
+        # A weighted citation count meets the integer threshold `t` if and only if its floor does
+        leadership_citations = np.floor(leadership_citations).astype(int)
+
+        self.first_year = int(years.min()) if len(years) else 0
+        self.years = np.arange(self.first_year, (years.max() if len(years) else -1)+1)
+        year_rows = years - self.first_year + 1
+        shape = (len(authors), len(self.years)+1)
+
+        self.publication_counts = np.zeros(shape, dtype=np.int32)
+        np.add.at(self.publication_counts, (author_rows, year_rows), 1)
+        self.publication_counts = np.cumsum(self.publication_counts, axis=1)
+        self.citation_counts = np.zeros(shape, dtype=np.int64)
+        np.add.at(self.citation_counts, (author_rows, year_rows), citations)
+        self.citation_counts = np.cumsum(self.citation_counts, axis=1)
+
+        self.h_counts = ThresholdCounts(author_rows, year_rows, citations, len(authors))
+        self.h_leadership_counts = ThresholdCounts(author_rows, year_rows, leadership_citations, len(authors))
+
+    def _year_index(self, year, default):
+        if year is None:
+            return default
+        return int(np.clip(year - self.first_year + 1, 0, len(self.years)))
+
+    def _window(self, start_year, end_year):
+        # Cumulative index before the first year of the window and of its last year
+        start = self._year_index(None if start_year is None else start_year - 1, 0)
+        end = self._year_index(end_year, len(self.years))
+        return start, max(start, end)
+
+    def _series(self, values, name):
+        return pd.Series(values, index=self.scopus_ids, name=name)
+
+    def publications(self, start_year=None, end_year=None):
+        '''
+        The number of publications of every author published between the years, inclusive.
+        '''
+        start, end = self._window(start_year, end_year)
+        return self._series(self.publication_counts[:, end] - self.publication_counts[:, start], 'Publications')
+
+    def total_citations(self, start_year=None, end_year=None):
+        '''
+        The total citations of the publications of every author published between the years, inclusive.
+        '''
+        start, end = self._window(start_year, end_year)
+        return self._series(self.citation_counts[:, end] - self.citation_counts[:, start], 'Total citations')
+
+    def h_index(self, start_year=None, end_year=None):
+        '''
+        The h-index of every author over the publications published between the years, inclusive.
+        '''
+        start, end = self._window(start_year, end_year)
+        return self._series(self.h_counts.window_h(start, end), 'h-index')
+
+    def h_leadership_index(self, start_year=None, end_year=None):
+        '''
+        The h-leadership index of every author over the publications published between the years, inclusive.
+        '''
+        start, end = self._window(start_year, end_year)
+        return self._series(self.h_leadership_counts.window_h(start, end), 'h-leadership-index')
+
+    def rolling(self, metric, window):
+        '''
+        The metric for every author over a rolling window of `window` years,
+        indexed by the last year of the window. The metric is one of
+        `publications`, `total_citations`, `h_index` or `h_leadership_index`.
+        '''
+        window = min(window, len(self.years))
+        end = np.arange(window, len(self.years)+1)
+        start = end - window
+        if metric in ('h_index', 'h_leadership_index'):
+            # One window at a time keeps the memory to one entry per author and threshold
+            counts = self.h_counts if metric == 'h_index' else self.h_leadership_counts
+            values = np.column_stack([counts.window_h(s, e) for s, e in zip(start, end)])
+        else:
+            counts = self.publication_counts if metric == 'publications' else self.citation_counts
+            values = counts[:, end] - counts[:, start]
+        return pd.DataFrame(values, index=self.scopus_ids, columns=self.years[end-1])